@@ -1,11 +1,19 @@
 """The file is the server for our application named "Survey App"."""
+import asyncio
 import os
-from fastapi import FastAPI, status
-from fastapi.responses import JSONResponse, RedirectResponse
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Literal
+from fastapi import FastAPI, Query, Request, status
+from fastapi.responses import ORJSONResponse, RedirectResponse, StreamingResponse
 from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from pymongo import MongoClient
-from pydantic import BaseModel
+from bson import ObjectId
+from cachetools import TTLCache
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import DuplicateKeyError
+import msgspec
+import orjson
 from dotenv import load_dotenv
 from argon2 import PasswordHasher
 from argon2.exceptions import VerifyMismatchError
@@ -13,8 +21,63 @@ from argon2.exceptions import VerifyMismatchError
 # from jwt import encode
 load_dotenv()
 
-hasher = PasswordHasher()
-app = FastAPI(title="Survey App", version="1.0.0")
+hasher = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1)
+# Argon2 is CPU-bound, so it runs in its own pool to keep it off the event loop
+hash_pool = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+
+def orjson_default(obj):
+    """Serialize the objects from MongoDB that orjson doesn't support.
+
+    Parameters
+    ----------
+    obj
+        The object that orjson can't serialize
+
+    Returns
+    -------
+    str
+        The string form of the ObjectId.
+    """
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError
+
+
+def encode_json(content) -> bytes:
+    """Encode the content to JSON with orjson, ObjectId included.
+
+    Parameters
+    ----------
+    content
+        The content to be encoded
+
+    Returns
+    -------
+    bytes
+        The JSON of the content.
+    """
+    return orjson.dumps(
+        content, default=orjson_default, option=orjson.OPT_NON_STR_KEYS
+    )
+
+
+class MongoJSONResponse(ORJSONResponse):
+    """An ORJSONResponse that can serialize documents from MongoDB.
+
+    FastAPI passes the values returned by a handler to jsonable_encoder
+    before rendering them, and it can't encode an ObjectId, so documents
+    must be returned wrapped in this response.
+    """
+
+    def render(self, content) -> bytes:
+        """Encode the content to JSON with orjson, ObjectId included."""
+        return encode_json(content)
+
+
+app = FastAPI(
+    title="Survey App", version="1.0.0", default_response_class=MongoJSONResponse
+)
 
 app.add_middleware(
     CORSMiddleware,
@@ -25,7 +88,7 @@ app.add_middleware(
 )
 
 
-class User(BaseModel):
+class User(msgspec.Struct):
     """Class that contains a basic information about a user.
 
     Attributes
@@ -41,7 +104,7 @@ class User(BaseModel):
     password: str
 
 
-class Form(BaseModel):
+class Form(msgspec.Struct):
     """Class that contains the basic information in a form, provided by the user.
 
     Attributes
@@ -61,7 +124,7 @@ class Form(BaseModel):
     description: str | None
 
 
-class Question(BaseModel):
+class Question(msgspec.Struct):
     """A class the contains the basic information in a question.
 
     Attributes
@@ -80,41 +143,230 @@ class Question(BaseModel):
 
     required: bool
         The question is required or not
+
+    type_of_input: Literal["checkbox", "radio", "text"]
+        The type of input used to answer the question, "text" by default
     """
 
     username: str
     form_id: str
     name: str
     answers: list | None
+    type_of_input: Literal["checkbox", "radio", "text"] = "text"
+
+
+class Answer(msgspec.Struct):
+    """A class that contains an answer to a question of a form.
+
+    Attributes
+    ----------
+    question: str
+        The name of the question to be answered
+
+    answer: str | list[str]
+        The answer to the question, a list of the choices for a checkbox
+    """
+
+    question: str
+    answer: str | list[str]
+
+
+user_decoder = msgspec.json.Decoder(User)
+form_decoder = msgspec.json.Decoder(Form)
+question_decoder = msgspec.json.Decoder(Question)
+answers_decoder = msgspec.json.Decoder(list[Answer])
+# The schemas of the request bodies, shown in the documentation
+body_schemas = {}
 
 
+def request_body(body_type) -> dict:
+    """Build the OpenAPI request body of the type decoded by msgspec.
+
+    The handlers decode the body themselves, so FastAPI can't document it
+    on its own.
+
+    Parameters
+    ----------
+    body_type
+        The type of the body, decoded by msgspec
+
+    Returns
+    -------
+    dict
+        The extra OpenAPI information of the path operation.
+    """
+    (schema,), components = msgspec.json.schema_components(
+        [body_type], ref_template="#/components/schemas/{name}"
+    )
+    body_schemas.update(components)
+    return {
+        "requestBody": {
+            "required": True,
+            "content": {"application/json": {"schema": schema}},
+        }
+    }
+
+
+def openapi() -> dict:
+    """Generate the OpenAPI schema, with the schemas of the request bodies."""
+    if app.openapi_schema is None:
+        schema = FastAPI.openapi(app)
+        schema.setdefault("components", {}).setdefault("schemas", {}).update(
+            body_schemas
+        )
+    return app.openapi_schema
+
+
+app.openapi = openapi
+
 CONNECTION_STRING = os.getenv("DB_URL")
+# The Procfile starts gunicorn with WEB_CONCURRENCY workers, and the pool size
+# is split between them
+WORKERS = max(1, int(os.getenv("WEB_CONCURRENCY", "4")))
+MAX_POOL_SIZE = max(1, int(os.getenv("DB_MAX_POOL_SIZE", "200")) // WORKERS)
+
+
+client = None
+user_cache = TTLCache(maxsize=10000, ttl=30)
+FORMS_BATCH_SIZE = 100
 
 
 def get_db():
-    """Get the database named "pollingpairDB"."""
-    client = MongoClient(CONNECTION_STRING)
+    """Get the database named "pollingpairDB" from the client of the worker.
+
+    Raises
+    ------
+    RuntimeError
+        If the server hasn't started, so there is no client yet.
+    """
+    if client is None:
+        raise RuntimeError("The database client is created when the server starts")
     return client["pollingpairDB"]
 
 
-users_collection = get_db()["Users"]
-forms_collection = get_db()["Forms"]
+@app.on_event("startup")
+async def connect_db():
+    """Connect to the database once the event loop is running.
+
+    The hook runs in every worker after it is forked, so the Motor client is
+    bound to the event loop of the worker and never inherited from the
+    parent process.
+    """
+    global client
+    client = AsyncIOMotorClient(
+        CONNECTION_STRING,
+        maxPoolSize=MAX_POOL_SIZE,
+        minPoolSize=min(5, MAX_POOL_SIZE),
+    )
+    db = get_db()
+    await db["Users"].create_index("username", unique=True)
+    await db["Forms"].create_index("author")
+    await db["Forms"].create_index("id")
+    await db["Answers"].create_index([("form_id", 1), ("_id", 1)])
+    await db["Answers"].create_index([("form_id", 1), ("question", 1), ("_id", 1)])
+
 
+@app.on_event("shutdown")
+async def disconnect_db():
+    """Close the client of the worker when the server shuts down."""
+    global client
+    if client is not None:
+        client.close()
+        client = None
 
-def find_user(username: str):
+
+async def find_user(username: str, projection: dict | None = None):
     """Find user function finds the user via the username.
 
+    Without a projection, only the "_id" and the "username" of the user are
+    returned, and they are cached for a short time.
+
     Parameters
     ----------
     username: str
         The username that the function will find.
 
+    projection: dict | None
+        The fields of the user to be returned, it bypasses the cache.
+
+    Returns
+    -------
+    dict | None
+        Returns the user document if a user has found in the database.
+    """
+    if projection is not None:
+        return await get_db()["Users"].find_one({"username": username}, projection)
+    user_founded = user_cache.get(username)
+    if user_founded is None:
+        user_founded = await get_db()["Users"].find_one(
+            {"username": username}, {"username": 1}
+        )
+        if user_founded is not None:
+            user_cache[username] = user_founded
+    return user_founded
+
+
+async def decode_body(request: Request, decoder: msgspec.json.Decoder):
+    """Decode and validate the body of the request using the decoder.
+
+    Parameters
+    ----------
+    request: Request
+        The request that contains the JSON body
+
+    decoder: msgspec.json.Decoder
+        The decoder of the expected object
+
     Returns
     -------
-    pymongo.collection.Collection | None
-        Returns a collection if a user has found in the database.
+    msgspec.Struct
+        The object decoded from the body.
+
+    Raises
+    ------
+    RequestValidationError
+        If the body is not a valid JSON or doesn't match the object.
     """
-    return users_collection.find_one({"username": username})
+    try:
+        return decoder.decode(await request.body())
+    except msgspec.ValidationError as exc:
+        message, _, path = str(exc).partition(" - at `$")
+        loc = ["body"]
+        for index, key in re.findall(r"\[(\d+)\]|\.([^.\[`]+)", path):
+            loc.append(int(index) if index else key)
+        raise RequestValidationError(
+            [{"loc": loc, "msg": message, "type": "value_error"}]
+        ) from exc
+    except msgspec.DecodeError as exc:
+        raise RequestValidationError(
+            [{"loc": ["body"], "msg": str(exc), "type": "json_invalid"}]
+        ) from exc
+
+
+async def stream_json_array(first_documents: list, cursor):
+    """Encode the documents of the cursor as a JSON array, one at a time.
+
+    Parameters
+    ----------
+    first_documents: list
+        The documents already fetched from the cursor
+
+    cursor: motor.motor_asyncio.AsyncIOMotorCursor
+        The cursor of the rest of the documents to be encoded
+
+    Yields
+    ------
+    bytes
+        The chunks of the JSON array.
+    """
+    separator = b"["
+    for document in first_documents:
+        yield separator + encode_json(document)
+        separator = b","
+    async for document in cursor:
+        yield separator + encode_json(document)
+        separator = b","
+    yield b"[]" if separator == b"[" else b"]"
 
 
 @app.get("/")
@@ -124,9 +376,11 @@ def root():
 
 
 @app.exception_handler(RequestValidationError)
-async def validation_exception_handler(exc: RequestValidationError):
+async def validation_exception_handler(
+    request: Request, exc: RequestValidationError
+):
     """It will return another attribute named "error"."""
-    return JSONResponse(
+    return MongoJSONResponse(
         status_code=422,
         content={
             "detail": exc.errors(),
@@ -135,59 +389,63 @@ async def validation_exception_handler(exc: RequestValidationError):
     )
 
 
-@app.post("/register")
-def register_user(user: User):
+@app.post("/register", openapi_extra=request_body(User))
+async def register_user(request: Request):
     """Register the user via the User Object, then, it will add it in the DB.
 
     Parameters
     ----------
-    user: User
-        The information of the user
+    request: Request
+        The request that contains the information of the user
 
     Returns
     -------
     dict
         If registering was succesful, it returns a dictionary.
     """
-    user_founded = find_user(user.username)
-    if user_founded:
-        return JSONResponse(
+    user = await decode_body(request, user_decoder)
+    password = await asyncio.get_running_loop().run_in_executor(
+        hash_pool, hasher.hash, user.password
+    )
+    data = {"username": user.username, "password": password}
+    try:
+        await get_db()["Users"].insert_one(data)
+    except DuplicateKeyError:
+        return MongoJSONResponse(
             status_code=status.HTTP_400_BAD_REQUEST,
             content={
                 "error": "The username has been found, please try another username"
             },
         )
-    password = hasher.hash(user.password)
-    data = {"username": user.username, "password": password}
-    users_collection.insert_one(data)
-    data["_id"] = str(data["_id"])
-    return data
+    user_cache.pop(user.username, None)
+    return MongoJSONResponse(data)
 
 
-@app.post("/login")
-def login_user(user: User):
+@app.post("/login", openapi_extra=request_body(User))
+async def login_user(request: Request):
     """Logins the user if the user exists.
 
     Parameters
     ----------
-    user: User
-        The information of the user
+    request: Request
+        The request that contains the information of the user
 
     Returns
     -------
     dict
     """
-    user_founded = find_user(user.username)
+    user = await decode_body(request, user_decoder)
+    user_founded = await find_user(user.username, {"password": 1})
     if user_founded is None:
-        return JSONResponse(
+        return MongoJSONResponse(
             status_code=400, content={"error": "User not found, please register"}
         )
-    user_founded["_id"] = str(user_founded["_id"])
-    user_founded["user_id"] = str(user_founded["_id"])
     try:
-        hasher.verify(user_founded["password"], user.password)
+        await asyncio.get_running_loop().run_in_executor(
+            hash_pool, hasher.verify, user_founded["password"], user.password
+        )
     except VerifyMismatchError:
-        return JSONResponse(
+        return MongoJSONResponse(
             status_code=400,
             content={"error": "The username and password doesn't match"},
         )
@@ -195,7 +453,7 @@ def login_user(user: User):
 
 
 @app.get("/forms/{username}")
-def get_user(username: str):
+async def get_user(username: str):
     """Returns the forms created by the user.
 
     Parameters
@@ -203,157 +461,214 @@ def get_user(username: str):
     username: str
         The username parameter is used to find the forms created by the user
     """
-    username_found = find_user(username)
+    username_found = await find_user(username)
     if username_found is None:
-        return JSONResponse(status_code=400, content={"error": "Username not found"})
-    forms_found = forms_collection.find({"username": username})
-    if forms_found is None:
-        return []
-    forms = []
-    for form_found in forms_found:
-        form_found["_id"] = str(form_found["_id"])
-        forms.append(form_found)
-    print(forms)
-    return forms
-
-
-@app.post("/form")
-def post_form(form: Form):
+        return MongoJSONResponse(
+            status_code=400, content={"error": "Username not found"}
+        )
+    forms_found = get_db()["Forms"].find({"author": username})
+    # The first batch is fetched before the response starts, so a failing
+    # query still returns an error instead of a truncated array
+    first_forms = await forms_found.to_list(FORMS_BATCH_SIZE)
+    return StreamingResponse(
+        stream_json_array(first_forms, forms_found), media_type="application/json"
+    )
+
+
+@app.post("/form", openapi_extra=request_body(Form))
+async def post_form(request: Request):
     """Create a form using the form parameter and store it in a database.
 
     Parameters
     ----------
-    form: Form
-        The form to be stored in the database
+    request: Request
+        The request that contains the form to be stored in the database
     Return
     ------
 
     """
-    user_founded = find_user(form.author)
-    print(user_founded)
+    form = await decode_body(request, form_decoder)
+    user_founded = await find_user(form.author)
     if user_founded is None:
-        return JSONResponse(status_code=400, content={"error": "User not found"})
+        return MongoJSONResponse(status_code=400, content={"error": "User not found"})
     if form.name == "":
-        return JSONResponse(
+        return MongoJSONResponse(
             status_code=400,
             content={"error": "The name of the form is blank, please try again"},
         )
+    form_id = ObjectId()
     data = {
+        "_id": form_id,
+        "id": str(form_id),
         "author": user_founded["username"],
         "name": form.name,
         "description": form.description or "",
+        "questions": [],
     }
-    forms_collection.insert_one(data)
-    data["_id"] = str(data["_id"])
-    forms_collection.find_one_and_update(
-        {"_id": data["_id"]},
-        {"$set": {"id": str(data["_id"])}},
-    )
-    return data
+    await get_db()["Forms"].insert_one(data)
+    return MongoJSONResponse(data)
 
 
-@app.post("/question")
-def add_question(question: Question):
+@app.post("/question", openapi_extra=request_body(Question))
+async def add_question(request: Request):
     """The function will add the question provided in the database.
 
     Parameters
     ----------
-    question: Question
-        The question to be stored in the database
+    request: Request
+        The request that contains the question to be stored in the database
     """
+    question = await decode_body(request, question_decoder)
     if question.form_id == "":
-        return JSONResponse(
+        return MongoJSONResponse(
             status_code=400,
             content={
                 "error": "The form id is blank, please try again with the form form id"
             },
         )
-    form_founded = forms_collection.find_one({"id": question.form_id})
+    form_founded = await get_db()["Forms"].find_one({"id": question.form_id})
     if form_founded is None:
-        return JSONResponse(status_code=400, content={"error": "The form is not found"})
-    print(form_founded)
-    questions_founded = form_founded["questions"]
-    for question_founded in questions_founded:
-        if question_founded["name"] == question.name:
-            return JSONResponse(
-                status_code=400,
-                content={
-                    "error": """Another question exists,
-                    please try again with another question"""
-                },
-            )
+        return MongoJSONResponse(
+            status_code=400, content={"error": "The form is not found"}
+        )
+    # The forms created before post_form wrote "questions" don't have it
+    questions_founded = form_founded.setdefault("questions", [])
+    name_to_idx = {q["name"]: i for i, q in enumerate(questions_founded)}
+    if question.name in name_to_idx:
+        return MongoJSONResponse(
+            status_code=400,
+            content={
+                "error": """Another question exists,
+                please try again with another question"""
+            },
+        )
     questions_founded.append(
         {
             "name": question.name,
+            "type_of_input": question.type_of_input,
         }
     )
-    forms_collection.update_one(
+    await get_db()["Forms"].update_one(
         {"id": question.form_id}, {"$set": {"questions": questions_founded}}
     )
-    form_founded["_id"] = str(form_founded["_id"])
-    return form_founded
+    return MongoJSONResponse(form_founded)
 
 
-@app.post("/answer/{form_id}")
-def answer_form(form_id, answers: list):
-    """The function take the form id, then insert the answer in the answers.
+@app.post("/answer/{form_id}", openapi_extra=request_body(list[Answer]))
+async def answer_form(form_id: str, request: Request):
+    """The function take the form id, then insert the answers in the Answers.
 
     Parameters
     ----------
-    form_id
+    form_id: str
         The ID of the form that will insert the answer
 
-    answers: list
-        The answers that the user gave
-    """
-    form_founded = forms_collection.find_one({"id": form_id})
+    request: Request
+        The request that contains the answers that the user gave
 
-    questions = form_founded["questions"]
-
-    if form_founded is None:
-        return JSONResponse(status_code=400, content={"error": "The form is not found"})
+    Returns
+    -------
+    list
+        The answers that has been stored in the database.
+    """
+    answers = await decode_body(request, answers_decoder)
     if not answers:
-        return JSONResponse(status_code=400, content={"error": "The answers are blank"})
+        return MongoJSONResponse(
+            status_code=400, content={"error": "The answers are blank"}
+        )
+    form_founded = await get_db()["Forms"].find_one(
+        {"id": form_id}, {"questions.name": 1, "questions.type_of_input": 1}
+    )
+    if form_founded is None:
+        return MongoJSONResponse(
+            status_code=400, content={"error": "The form is not found"}
+        )
+    # The questions added before type_of_input existed are text questions
+    types_of_input = {
+        question["name"]: question.get("type_of_input", "text")
+        for question in form_founded.get("questions", [])
+    }
+    if not types_of_input:
+        return MongoJSONResponse(
+            status_code=400,
+            content={
+                "error": """The user haven't created a question in the form yet,
+                please try again"""
+            },
+        )
+    documents = []
     for answer in answers:
-        if type(answer) is not dict:
-            return JSONResponse(
+        # A blank answer is an empty string, or no choices for a checkbox
+        if not answer.question or not answer.answer:
+            return MongoJSONResponse(
                 status_code=400,
-                content={"error": "The answer should be in a dictionary/JSON"},
+                content={"error": "The question or the answer is blank"},
             )
-        try:
-            if not answer["question"] or not answer["answer"]:
-                return JSONResponse(
-                    status_code=400,
-                    content={"error": "The question or the answer is blank"},
-                )
-            question_names = []
-            for question in questions:
-                question_names.append(question["name"])
-            if not question_names:
-                return JSONResponse(
+        type_of_input = types_of_input.get(answer.question)
+        if type_of_input is None:
+            return MongoJSONResponse(
+                status_code=400,
+                content={"error": "The question is not in the form"},
+            )
+        if isinstance(answer.answer, list):
+            if type_of_input != "checkbox":
+                return MongoJSONResponse(
                     status_code=400,
                     content={
-                        "error": """The user haven't created a question in the form yet,
-                        please try again"""
+                        "error": "Only a checkbox question can have many answers"
                     },
                 )
-            for i, question_name in enumerate(question_names):
-                if answer["question"] not in question_names:
-                    return JSONResponse(
-                        status_code=400,
-                        content={"error": "The question is not in the form"},
-                    )
-                answers_found = form_founded["questions"][i]["answers"]
-                if answer["question"] == question_name:
-                    answers_found.append(answer["answer"])
-                    forms_collection.update_one(
-                        {"id": form_id},
-                        {"$set": {f"questions.{i}.answers": answers_found}},
-                    )
-                    form_founded["_id"] = str(form_founded["_id"])
-                    return form_founded
-        except KeyError:
-            return JSONResponse(
-                status_code=400,
-                content={"error": "The question or the answer is blank"},
-            )
+            if not all(answer.answer):
+                return MongoJSONResponse(
+                    status_code=400,
+                    content={"error": "The question or the answer is blank"},
+                )
+        documents.append(
+            {
+                "form_id": form_id,
+                "question": answer.question,
+                "answer": answer.answer,
+            }
+        )
+    await get_db()["Answers"].insert_many(documents)
+    return MongoJSONResponse(documents)
+
+
+@app.get("/answers/{form_id}")
+async def get_answers(
+    form_id: str,
+    question: str | None = None,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=1000),
+):
+    """Returns a page of the answers given to the form.
+
+    The answers given before the Answers collection existed are still in the
+    questions of the form, returned by the forms of the user.
+
+    Parameters
+    ----------
+    form_id: str
+        The ID of the form of the answers
+
+    question: str | None
+        The name of the question of the answers, all of them if None
+
+    skip: int
+        The number of answers to be skipped
+
+    limit: int
+        The maximum number of answers to be returned
+
+    Returns
+    -------
+    list
+        The answers, from the oldest to the newest.
+    """
+    query = {"form_id": form_id}
+    if question is not None:
+        query["question"] = question
+    answers_found = (
+        get_db()["Answers"].find(query).sort("_id", 1).skip(skip).limit(limit)
+    )
+    return MongoJSONResponse(await answers_found.to_list(limit))